@@ -2,19 +2,30 @@ from io import BytesIO
 import asyncio
 import os
 import logging
-import time
 import hashlib
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from typing import Optional
 
+import numpy as np
 from fastapi import FastAPI, File, UploadFile, Query, HTTPException
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image, ImageChops, ImageFilter, ImageOps
-from rembg import remove, new_session
+from PIL import Image, ImageChops, ImageFilter
+
+from runtime import (
+    EXECUTOR, INFERENCE_EXECUTOR, ORT_QUANTIZE, ByteLRU, get_session,
+    prepare_int8_models, remove_background,
+)
 
 # --- App setup ---
-app = FastAPI(title="Remove Background API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if ORT_QUANTIZE == "int8":
+        await asyncio.get_running_loop().run_in_executor(
+            None, prepare_int8_models, [p["model"] for p in PRESETS.values()])
+    yield
+
+app = FastAPI(title="Remove Background API", version="1.0.0", lifespan=lifespan)
 logger = logging.getLogger("uvicorn.error")
 logging.basicConfig(level=logging.INFO)
 
@@ -36,16 +47,8 @@ async def health():
     return {"status": "ok"}
 
 # --- Model sessions ---
-SESSIONS: dict[str, object] = {}
 DEFAULT_MODEL = os.getenv("DEFAULT_REMBG_MODEL", "birefnet-general")
 
-def get_session(model_name: str = DEFAULT_MODEL) -> object:
-    if model_name not in SESSIONS:
-        SESSIONS[model_name] = new_session(model_name)
-    return SESSIONS[model_name]
-
-EXECUTOR = ThreadPoolExecutor(max_workers=min(2, os.cpu_count() or 2))
-
 # --- Presets ---
 PRESETS = {
     "fast": {"model": "u2netp", "max_side": 640, "matting": False},
@@ -53,18 +56,36 @@ PRESETS = {
     "quality": {"model": DEFAULT_MODEL, "max_side": 2048, "matting": True},
 }
 
-CACHE: dict[str, bytes] = {}
+CACHE = ByteLRU(int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Level 1 deflate is several times faster than 6 for ~10-15% larger files.
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))
 
 # ----------------- Helpers -----------------
 def _ensure_rgba(img: Image.Image) -> Image.Image:
     return img.convert("RGBA") if img.mode != "RGBA" else img
 
-def _hash_bytes(data: bytes) -> str:
-    return hashlib.sha256(data).hexdigest()
+async def _hash_upload(file: UploadFile, params: str) -> Optional[str]:
+    """Hash the upload in chunks and rewind it; None if it is empty."""
+    h = hashlib.blake2b(digest_size=16)
+    size = 0
+    await file.seek(0)
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        h.update(chunk)
+        size += len(chunk)
+    if not size:
+        return None
+    h.update(params.encode())
+    await file.seek(0)
+    return h.hexdigest()
+
+def _encode_png(img: Image.Image) -> bytes:
+    buf = BytesIO()
+    img.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
 
 def _crop_with_margin(img: Image.Image, margin: int = 10) -> Image.Image:
-    alpha = img.split()[-1]
-    bbox = alpha.getbbox()
+    bbox = img.getchannel("A").getbbox()
     if not bbox:
         return img
     left, top, right, bottom = bbox
@@ -72,8 +93,16 @@ def _crop_with_margin(img: Image.Image, margin: int = 10) -> Image.Image:
     top = max(top - margin, 0)
     right = min(right + margin, img.width)
     bottom = min(bottom + margin, img.height)
-    cropped = img.crop((left, top, right, bottom))
-    return ImageOps.expand(cropped, border=margin, fill=(0, 0, 0, 0))
+    # One crop does the padding too: crop() zero-fills whatever lies past the
+    # image edge. Inside the image the ring is alpha 0 but may still carry
+    # colour, so clear it to match a padded crop.
+    out = img.crop((left - margin, top - margin, right + margin, bottom + margin))
+    if margin:
+        w, h = out.size
+        for box in ((0, 0, w, margin), (0, h - margin, w, h),
+                    (0, margin, margin, h - margin), (w - margin, margin, w, h - margin)):
+            out.paste((0, 0, 0, 0), box)
+    return out
 
 # ----------------- Main Endpoint -----------------
 @app.post("/remove-bg", response_class=StreamingResponse)
@@ -85,15 +114,15 @@ async def remove_bg(
         crop: bool = Query(True),
         crop_margin: int = Query(10, ge=0, le=200),
 ):
-    contents = await file.read()
-    if not contents:
+    # UploadFile is already spooled to a temp file, so hash and decode
+    # straight from it instead of buffering the whole body in memory.
+    cache_key = await _hash_upload(file, f"{preset}:{size}:{model}:{crop}:{crop_margin}")
+    if cache_key is None:
         raise HTTPException(status_code=400, detail="Empty file uploaded")
 
-    cache_key = _hash_bytes(contents + f"{preset}:{size}:{model}:{crop}:{crop_margin}".encode())
-    if cache_key in CACHE:
-        buf = BytesIO(CACHE[cache_key])
-        buf.seek(0)
-        return StreamingResponse(buf, media_type="image/png")
+    cached = CACHE.get(cache_key)
+    if cached is not None:
+        return StreamingResponse(BytesIO(cached), media_type="image/png")
 
     chosen_model = model or PRESETS.get(preset, PRESETS["quality"])["model"]
     try:
@@ -104,7 +133,7 @@ async def remove_bg(
     preset_cfg = PRESETS.get(preset, PRESETS["quality"])
     max_side = preset_cfg["max_side"]
 
-    original = Image.open(BytesIO(contents)).convert("RGBA")
+    original = Image.open(file.file)
     ow, oh = original.size
 
     proc_max_side = {
@@ -114,39 +143,44 @@ async def remove_bg(
     }[size]
 
     scale = 1.0
-    proc_img = original
     if max(ow, oh) > proc_max_side:
         scale = proc_max_side / float(max(ow, oh))
         new_w = int(round(ow * scale))
         new_h = int(round(oh * scale))
-        proc_img = original.resize((new_w, new_h), Image.LANCZOS)
-
-    data = BytesIO()
-    proc_img.save(data, format="PNG", optimize=True)
-    data_bytes = data.getvalue()
+        # Only the downscaled image feeds the model, so let libjpeg decode at
+        # a reduced DCT scale no smaller than the target (no-op for non-JPEG).
+        original.draft("RGB", (new_w, new_h))
+
+    # rembg and the output path handle RGB directly; only other modes need
+    # converting, and RGBA keeps any transparency the upload already had.
+    if original.mode not in ("RGB", "RGBA"):
+        original = original.convert("RGBA")
+    proc_img = original
+    if scale != 1.0:
+        proc_img = original.resize((new_w, new_h), Image.LANCZOS, reducing_gap=3.0)
 
     loop = asyncio.get_running_loop()
-    removed_bytes = await loop.run_in_executor(
-        EXECUTOR,
-        lambda: remove(data_bytes, session=session)
+    # An ndarray skips the PNG encode/decode round trip; unlike a PIL image
+    # it also carries no EXIF, so rembg won't re-orient the result.
+    removed = await loop.run_in_executor(
+        INFERENCE_EXECUTOR,
+        lambda: remove_background(session, np.asarray(proc_img))
     )
 
-    removed = Image.open(BytesIO(removed_bytes)).convert("RGBA")
+    removed = Image.fromarray(removed)
     if scale != 1.0:
         removed = removed.resize((ow, oh), Image.LANCZOS)
 
     if crop:
         removed = _crop_with_margin(removed, crop_margin)
 
-    buf = BytesIO()
-    removed.save(buf, format="PNG", optimize=True, compress_level=6)
-    buf.seek(0)
-    CACHE[cache_key] = buf.getvalue()
+    png = await loop.run_in_executor(EXECUTOR, _encode_png, removed)
+    CACHE.put(cache_key, png)
 
     # Free memory
     del original, removed
 
-    return StreamingResponse(buf, media_type="image/png")
+    return StreamingResponse(BytesIO(png), media_type="image/png")
 
 
 if __name__ == "__main__":
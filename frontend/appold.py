@@ -5,17 +5,29 @@ import os
 import logging
 import time
 import hashlib
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from typing import Optional
 
+import numpy as np
 from fastapi import FastAPI, File, UploadFile, Query, HTTPException
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image, ImageChops, ImageFilter, ImageOps
-from rembg import remove, new_session
+from PIL import Image, ImageFilter
+
+from runtime import (
+    EXECUTOR, INFERENCE_EXECUTOR, ORT_QUANTIZE, ByteLRU, get_session,
+    prepare_int8_models, remove_background,
+)
 
 # --- App setup ---
-app = FastAPI(title="Remove Background API (Transparent PNG)", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if ORT_QUANTIZE == "int8":
+        await asyncio.get_running_loop().run_in_executor(
+            None, prepare_int8_models, [p["model"] for p in PRESETS.values()])
+    yield
+
+app = FastAPI(title="Remove Background API (Transparent PNG)", version="1.0.0", lifespan=lifespan)
 logger = logging.getLogger("uvicorn.error")
 logging.basicConfig(level=logging.INFO)
 
@@ -28,17 +40,8 @@ app.add_middleware(
 )
 
 # --- Model sessions (Lazy Loading for Memory) ---
-SESSIONS: dict[str, object] = {}
 DEFAULT_MODEL = os.getenv("DEFAULT_REMBG_MODEL", "birefnet-general")
 
-def get_session(model_name: str = DEFAULT_MODEL) -> object:
-    """Lazy load sessions to save memory"""
-    if model_name not in SESSIONS:
-        SESSIONS[model_name] = new_session(model_name)
-    return SESSIONS[model_name]
-
-EXECUTOR = ThreadPoolExecutor(max_workers=min(2, os.cpu_count() or 2))  # Limit workers for memory
-
 # --- Presets ---
 PRESETS = {
     "fast": {"model": "u2netp", "max_side": 640, "matting": False},
@@ -46,7 +49,10 @@ PRESETS = {
     "quality": {"model": DEFAULT_MODEL, "max_side": 2048, "matting": True},
 }
 
-CACHE: dict[str, bytes] = {}
+CACHE = ByteLRU(int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Level 1 deflate is several times faster than 6 for ~10-15% larger files.
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))
 
 # Removed warmup to save memory - models load on first use
 
@@ -55,38 +61,88 @@ CACHE: dict[str, bytes] = {}
 def _ensure_rgba(img: Image.Image) -> Image.Image:
     return img.convert("RGBA") if img.mode != "RGBA" else img
 
-def _hash_bytes(data: bytes) -> str:
-    return hashlib.sha256(data).hexdigest()
+async def _hash_upload(file: UploadFile, params: str) -> Optional[str]:
+    """Hash the upload in chunks and rewind it; None if it is empty."""
+    h = hashlib.blake2b(digest_size=16)
+    size = 0
+    await file.seek(0)
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        h.update(chunk)
+        size += len(chunk)
+    if not size:
+        return None
+    h.update(params.encode())
+    await file.seek(0)
+    return h.hexdigest()
+
+def _rank_filter(arr: np.ndarray, radius: int, op: np.ufunc) -> np.ndarray:
+    # Square min/max filter as two 1-D passes: O(k) per pixel instead of the
+    # O(k^2) of Pillow's Min/MaxFilter, with the same edge replication.
+    h, w = arr.shape
+    padded = np.pad(arr, radius, mode="edge")
+    rows = padded[:, :w].copy()
+    for dx in range(1, 2 * radius + 1):
+        op(rows, padded[:, dx:dx + w], out=rows)
+    out = rows[:h].copy()
+    for dy in range(1, 2 * radius + 1):
+        op(out, rows[dy:dy + h], out=out)
+    return out
+
+# Per-value lookup for lifting faint edge alpha; point() applies it in C.
+_DARK_EDGE_LUT = [min(255, int(v * 1.4) + 6) if v < 64 else v for v in range(256)]
 
 def _refine_alpha(mask: Image.Image, contract: int = 1, expand: int = 2, small_blur: float = 1.0, boost_dark_edges: bool = True) -> Image.Image:
-    a = mask.convert("L")
-    if contract > 0:
-        a = a.filter(ImageFilter.MinFilter(contract * 2 + 1))
-    if expand > 0:
-        a = a.filter(ImageFilter.MaxFilter(expand * 2 + 1))
+    a = mask if mask.mode == "L" else mask.convert("L")
+    if contract > 0 or expand > 0:
+        arr = np.asarray(a)
+        if contract > 0:
+            arr = _rank_filter(arr, contract, np.minimum)
+        if expand > 0:
+            arr = _rank_filter(arr, expand, np.maximum)
+        a = Image.fromarray(arr, "L")
     if small_blur > 0:
         a = a.filter(ImageFilter.GaussianBlur(small_blur))
 
     if boost_dark_edges:
-        px = a.load()
-        for y in range(a.height):
-            for x in range(a.width):
-                v = px[x, y]
-                if v < 64:
-                    px[x, y] = min(255, int(v * 1.4) + 6)
+        a = a.point(_DARK_EDGE_LUT)
     return a
 
+def _apply_alpha(img: Image.Image, alpha: Image.Image) -> Image.Image:
+    # Same pixels as compositing img over transparent black with alpha as the
+    # mask (every channel scaled by alpha, rounded like Pillow's blend), but
+    # written straight into one RGBA buffer without a full-size RGBA copy of img.
+    src = np.asarray(img)
+    a = np.asarray(alpha).astype(np.uint16)
+    out = np.empty(a.shape + (4,), np.uint8)
+    tmp = np.empty_like(a)
+    for c in range(src.shape[2]):
+        np.multiply(src[..., c], a, out=tmp)
+        tmp += 128
+        tmp += tmp >> 8
+        np.right_shift(tmp, 8, out=out[..., c], casting="unsafe")
+    if src.shape[2] == 3:
+        out[..., 3] = a
+    return Image.fromarray(out, "RGBA")
+
 def _premultiply_and_clean(img: Image.Image) -> Image.Image:
-    img = _ensure_rgba(img)
-    r, g, b, a = img.split()
-    r = ImageChops.multiply(r, a)
-    g = ImageChops.multiply(g, a)
-    b = ImageChops.multiply(b, a)
-    return Image.merge("RGBA", (r, g, b, a))
+    # One in-place pass per colour channel instead of split/multiply/merge;
+    # truncating division matches ImageChops.multiply.
+    arr = np.array(_ensure_rgba(img))
+    a = arr[..., 3].astype(np.uint16)
+    tmp = np.empty_like(a)
+    for c in range(3):
+        np.multiply(arr[..., c], a, out=tmp)
+        tmp //= 255
+        arr[..., c] = tmp
+    return Image.fromarray(arr, "RGBA")
+
+def _encode_png(img: Image.Image) -> bytes:
+    buf = BytesIO()
+    img.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
 
 def _crop_with_margin(img: Image.Image, margin: int = 10) -> Image.Image:
-    alpha = img.split()[-1]
-    bbox = alpha.getbbox()
+    bbox = img.getchannel("A").getbbox()
     if not bbox:
         return img
     left, top, right, bottom = bbox
@@ -94,8 +150,16 @@ def _crop_with_margin(img: Image.Image, margin: int = 10) -> Image.Image:
     top = max(top - margin, 0)
     right = min(right + margin, img.width)
     bottom = min(bottom + margin, img.height)
-    cropped = img.crop((left, top, right, bottom))
-    return ImageOps.expand(cropped, border=margin, fill=(0, 0, 0, 0))
+    # One crop does the padding too: crop() zero-fills whatever lies past the
+    # image edge. Inside the image the ring is alpha 0 but may still carry
+    # colour, so clear it to match a padded crop.
+    out = img.crop((left - margin, top - margin, right + margin, bottom + margin))
+    if margin:
+        w, h = out.size
+        for box in ((0, 0, w, margin), (0, h - margin, w, h),
+                    (0, margin, margin, h - margin), (w - margin, margin, w, h - margin)):
+            out.paste((0, 0, 0, 0), box)
+    return out
 
 
 # ----------------- Main Endpoint -----------------
@@ -112,15 +176,15 @@ async def remove_bg(
         crop_margin: int = Query(10, ge=0, le=200),
 ):
     start = time.perf_counter()
-    contents = await file.read()
-    if not contents:
+    # UploadFile is already spooled to a temp file, so hash and decode
+    # straight from it instead of buffering the whole body in memory.
+    cache_key = await _hash_upload(file, f"{preset}:{size}:{model}:{refine}:{apply_despill}:{boost_dark_edges}:{crop}:{crop_margin}")
+    if cache_key is None:
         raise HTTPException(status_code=400, detail="Empty file uploaded")
 
-    cache_key = _hash_bytes(contents + f"{preset}:{size}:{model}:{refine}:{apply_despill}:{boost_dark_edges}:{crop}:{crop_margin}".encode())
-    if cache_key in CACHE:
-        buf = BytesIO(CACHE[cache_key])
-        buf.seek(0)
-        return StreamingResponse(buf, media_type="image/png")
+    cached = CACHE.get(cache_key)
+    if cached is not None:
+        return StreamingResponse(BytesIO(cached), media_type="image/png")
 
     chosen = model or PRESETS.get(preset, PRESETS["quality"])["model"]
 
@@ -132,7 +196,11 @@ async def remove_bg(
     preset_cfg = PRESETS.get(preset, PRESETS["quality"])
     max_side = preset_cfg["max_side"]
 
-    original = Image.open(BytesIO(contents)).convert("RGBA")
+    original = Image.open(file.file)
+    # rembg and the output path handle RGB directly; only other modes need
+    # converting, and RGBA keeps any transparency the upload already had.
+    if original.mode not in ("RGB", "RGBA"):
+        original = original.convert("RGBA")
     ow, oh = original.size
 
     if size == "preview":
@@ -150,37 +218,34 @@ async def remove_bg(
         scale = max_processing / float(max(ow, oh))
         new_w = int(round(ow * scale))
         new_h = int(round(oh * scale))
-        proc_img = original.resize((new_w, new_h), Image.LANCZOS)
-
-    data = BytesIO()
-    proc_img.save(data, format="PNG", optimize=True)  # Memory optimization
-    data_bytes = data.getvalue()
+        proc_img = original.resize((new_w, new_h), Image.LANCZOS, reducing_gap=3.0)
 
     # Use the already loaded session
     loop = asyncio.get_running_loop()
-    removed_bytes = await loop.run_in_executor(
-        EXECUTOR,
-        lambda: remove(
-            data_bytes,
-            session=session,
+    # An ndarray skips the PNG encode/decode round trip; unlike a PIL image
+    # it also carries no EXIF, so rembg won't re-orient the result.
+    removed = await loop.run_in_executor(
+        INFERENCE_EXECUTOR,
+        lambda: remove_background(
+            session,
+            np.asarray(proc_img),
             only_mask=False,
-            alpha_matting=True,
+            alpha_matting=preset_cfg["matting"],
             alpha_matting_foreground_threshold=245,
             alpha_matting_background_threshold=10,
             alpha_matting_erode_size=3,
         )
     )
 
-    removed = Image.open(BytesIO(removed_bytes)).convert("RGBA")
-    r, g, b, a = removed.split()
+    removed = Image.fromarray(removed)
+    a = removed.getchannel("A")
     if scale != 1.0:
         a = a.resize((ow, oh), Image.NEAREST)
 
     if refine:
         a = _refine_alpha(a, contract=1, expand=2, small_blur=1.0, boost_dark_edges=boost_dark_edges)
 
-    out = Image.new("RGBA", original.size, (0,0,0,0))
-    out = Image.composite(original, out, a)
+    out = _apply_alpha(original, a)
 
     if apply_despill:
         out = _premultiply_and_clean(out)
@@ -188,15 +253,13 @@ async def remove_bg(
     if crop:
         out = _crop_with_margin(out, crop_margin)
 
-    buf = BytesIO()
-    out.save(buf, format="PNG", optimize=True, compress_level=6)  # Memory optimization
-    buf.seek(0)
-    CACHE[cache_key] = buf.getvalue()
+    png = await loop.run_in_executor(EXECUTOR, _encode_png, out)
+    CACHE.put(cache_key, png)
 
     # Clear large objects from memory
     del original, removed, out, a
 
-    return StreamingResponse(buf, media_type="image/png")
+    return StreamingResponse(BytesIO(png), media_type="image/png")
 
 
 @app.get("/health")
@@ -0,0 +1,318 @@
+# Model sessions, ORT tuning and worker pools shared by the API handlers.
+import os
+import logging
+import time
+import threading
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Optional
+
+import numpy as np
+import onnxruntime as ort
+from rembg import remove
+from rembg.sessions import sessions_class
+from rembg.sessions.base import BaseSession
+
+logger = logging.getLogger("uvicorn.error")
+
+ORT_CACHE_DIR = os.getenv("ORT_CACHE_DIR", "/tmp/rmbg-ort")
+# "int8" swaps in dynamically quantized weights (smaller, faster on CPU),
+# prepared for the preset models at startup; needs the `onnx` package.
+ORT_QUANTIZE = os.getenv("ORT_QUANTIZE", "").lower()
+# Concurrent inferences on one session are merged into a single run() call.
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "2"))
+BATCH_WAIT_MS = float(os.getenv("BATCH_WAIT_MS", "10"))
+# Minimum time between two releases of a session's memory arena.
+ARENA_SHRINK_INTERVAL_S = float(os.getenv("ARENA_SHRINK_INTERVAL_S", "30"))
+# Requests whose rembg pre/post-processing (alpha matting included) may run at
+# once; only a batchable session admits more, up to BATCH_MAX_SIZE.
+PIPELINE_WORKERS = min(2, os.cpu_count() or 2)  # Limit workers for memory
+
+# --- Model sessions ---
+SESSIONS: dict[str, object] = {}
+
+def get_session(model_name: str) -> object:
+    """Lazy load sessions to save memory"""
+    if model_name not in SESSIONS:
+        SESSIONS[model_name] = _build_session(model_name)
+    return SESSIONS[model_name]
+
+def _session_options() -> ort.SessionOptions:
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # _BatchedRun serializes runs per session, so one model never competes
+    # with itself for the intra-op pool. Different models still run side by
+    # side, each with a full-width pool; set OMP_NUM_THREADS to cap it when
+    # several models serve traffic at once.
+    if "OMP_NUM_THREADS" in os.environ:
+        opts.intra_op_num_threads = int(os.environ["OMP_NUM_THREADS"])
+    return opts
+
+def _int8_path(model_path: str) -> str:
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(ORT_CACHE_DIR, f"{stem}.int8.onnx")
+
+def _quantize_int8(model_path: str) -> None:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized = _int8_path(model_path)
+    if os.path.exists(quantized):
+        return
+    os.makedirs(ORT_CACHE_DIR, exist_ok=True)
+    tmp = f"{quantized}.{os.getpid()}.tmp"
+    try:
+        # uint8 weights: ORT's CPU ConvInteger kernel has long only taken
+        # uint8, and these models are almost entirely Conv.
+        quantize_dynamic(model_path, tmp, weight_type=QuantType.QUInt8)
+        os.replace(tmp, quantized)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def prepare_int8_models(model_names: Iterable[str]) -> None:
+    for model_name in sorted(set(model_names)):
+        try:
+            session_class = _session_class(model_name)
+            if session_class.__init__ is BaseSession.__init__:
+                _quantize_int8(str(session_class.download_models()))
+        except Exception:
+            logger.exception("INT8 quantization of '%s' failed; it will run in FP32", model_name)
+
+def _with_model_path(session_class: type, model_path: str) -> type:
+    # rembg resolves the .onnx file through download_models(); point it elsewhere.
+    class _Session(session_class):
+        @classmethod
+        def download_models(cls, *args, **kwargs):
+            return model_path
+    return _Session
+
+class _BatchedRun:
+    """Stand-in for a session's InferenceSession that funnels every run()
+    through one worker thread, so concurrent requests never oversubscribe
+    ORT's intra-op pool, and merges concurrent batch-1 calls into one."""
+
+    def __init__(self, inner: ort.InferenceSession):
+        self._inner = inner
+        # Models exported with a fixed batch of 1 still run one at a time here.
+        inputs = inner.get_inputs()
+        self._batchable = all(not isinstance(i.shape[0], int) for i in inputs)
+        logger.info("ORT batching %s for inputs %s",
+                    "enabled" if self._batchable else "disabled (fixed batch axis)",
+                    [i.shape for i in inputs])
+        # Batched runs grow the memory arena past the single-image working set.
+        # Once runs drop below the largest batch since the last release, one
+        # of them gives the excess back; under sustained load the arena keeps
+        # its size instead of being freed and regrown on every run.
+        self._shrink = ort.RunOptions()
+        devices = "cpu:0;gpu:0" if "CUDAExecutionProvider" in inner.get_providers() else "cpu:0"
+        self._shrink.add_run_config_entry("memory.enable_memory_arena_shrinkage", devices)
+        self._peak = 1
+        self._last_shrink = 0.0
+        self._slots = threading.BoundedSemaphore(
+            max(BATCH_MAX_SIZE, PIPELINE_WORKERS) if self._batchable else PIPELINE_WORKERS)
+        # Requests inside expecting() that have not reached run() yet; the
+        # worker only holds a batch open while some are on their way.
+        self._expected = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._queue: queue.Queue = queue.Queue()
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+    @contextmanager
+    def expecting(self):
+        with self._slots:
+            with self._lock:
+                self._expected += 1
+            self._local.expected = True
+            try:
+                yield
+            finally:
+                self._arrived()
+
+    def _arrived(self) -> None:
+        if getattr(self._local, "expected", False):
+            self._local.expected = False
+            with self._lock:
+                self._expected -= 1
+
+    def run(self, output_names, input_feed, run_options=None):
+        self._arrived()
+        done: Future = Future()
+        self._queue.put((output_names, input_feed, run_options, done))
+        return done.result()
+
+    def _worker(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            try:
+                self._collect(batch)
+                for items in self._group(batch):
+                    self._run_group(items)
+            except Exception as e:
+                # Never let a bad feed kill the thread and strand the callers.
+                for item in batch:
+                    if not item[3].done():
+                        item[3].set_exception(e)
+
+    def _collect(self, batch: list) -> None:
+        if not self._batchable:
+            return
+        deadline = time.monotonic() + BATCH_WAIT_MS / 1000
+        while len(batch) < BATCH_MAX_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._expected:
+                return
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                return
+
+    def _group(self, batch: list) -> list:
+        groups: dict[tuple, list] = {}
+        for item in batch:
+            names, feed, run_options, _ = item
+            if self._batchable and all(
+                    isinstance(v, np.ndarray) and v.shape[:1] == (1,) for v in feed.values()):
+                key = (tuple(names or ()), id(run_options),
+                       tuple((k, v.shape, v.dtype.str) for k, v in sorted(feed.items())))
+            else:
+                key = (id(item),)
+            groups.setdefault(key, []).append(item)
+        return list(groups.values())
+
+    def _release_arena(self, size: int) -> bool:
+        self._peak = max(self._peak, size)
+        now = time.monotonic()
+        if size >= self._peak or now - self._last_shrink < ARENA_SHRINK_INTERVAL_S:
+            return False
+        self._peak = size
+        self._last_shrink = now
+        return True
+
+    def _run_group(self, items: list) -> None:
+        names, feed, run_options, _ = items[0]
+        if run_options is None and self._release_arena(len(items)):
+            run_options = self._shrink
+        try:
+            if len(items) == 1:
+                results = [self._inner.run(names, feed, run_options)]
+            else:
+                stacked = {k: np.concatenate([item[1][k] for item in items]) for k in feed}
+                outs = self._inner.run(names, stacked, run_options)
+                results = [[o[i:i + 1] for o in outs] for i in range(len(items))]
+        except Exception as e:
+            for item in items:
+                item[3].set_exception(e)
+            return
+        for item, result in zip(items, results):
+            item[3].set_result(result)
+
+def _load_optimized(session_class: type, model_name: str, model_path: str,
+                    opts: ort.SessionOptions) -> object:
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    optimized = os.path.join(
+        ORT_CACHE_DIR, f"{stem}.ort{ort.__version__}.{ort.get_device().lower()}.extended.onnx")
+    # The file holds only the portable fusions (ORT_ENABLE_EXTENDED). The
+    # CPU-specific layout transforms (NCHWc blocking) are redone at load time
+    # on the host that runs the model, so a cache on a shared volume is safe.
+    if os.path.exists(optimized):
+        try:
+            return _with_model_path(session_class, optimized)(model_name, opts)
+        except Exception:
+            logger.warning("Ignoring unloadable optimized graph %s", optimized, exc_info=True)
+
+    # ORT writes the graph while creating the session; only publish it once
+    # that succeeded, so a crash or a concurrent worker never sees a partial file.
+    os.makedirs(ORT_CACHE_DIR, exist_ok=True)
+    tmp = f"{optimized}.{os.getpid()}.tmp"
+    save_opts = _session_options()
+    save_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    save_opts.optimized_model_filepath = tmp
+    try:
+        _with_model_path(session_class, model_path)(model_name, save_opts)
+        os.replace(tmp, optimized)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return _with_model_path(session_class, optimized)(model_name, opts)
+
+def _session_class(model_name: str) -> type:
+    session_class = next((sc for sc in sessions_class if sc.name() == model_name), None)
+    if session_class is None:
+        raise ValueError(f"No session class found for model '{model_name}'")
+    return session_class
+
+def _build_session(model_name: str) -> object:
+    session_class = _session_class(model_name)
+    opts = _session_options()
+
+    # Single-model sessions get their optimized graph persisted, so later
+    # process starts load it directly and skip graph optimization.
+    if session_class.__init__ is BaseSession.__init__:
+        model_path = str(session_class.download_models())
+        # Quantized files are prepared at startup, never on the request path.
+        if ORT_QUANTIZE == "int8":
+            if os.path.exists(_int8_path(model_path)):
+                model_path = _int8_path(model_path)
+            else:
+                logger.warning("No INT8 model prepared for '%s'; using FP32", model_name)
+        session = _load_optimized(session_class, model_name, model_path, opts)
+    else:
+        session = session_class(model_name, opts)
+
+    if hasattr(session, "inner_session"):
+        session.inner_session = _BatchedRun(session.inner_session)
+    return session
+
+# Slots for sessions without a _BatchedRun to hold theirs.
+_PIPELINE_SLOTS = threading.BoundedSemaphore(PIPELINE_WORKERS)
+
+def remove_background(session: object, img: np.ndarray, **kwargs) -> np.ndarray:
+    # Let the session's batcher know this request is heading for run().
+    inner = getattr(session, "inner_session", None)
+    with inner.expecting() if isinstance(inner, _BatchedRun) else _PIPELINE_SLOTS:
+        return remove(img, session=session, **kwargs)
+
+EXECUTOR = ThreadPoolExecutor(max_workers=min(2, os.cpu_count() or 2))  # Limit workers for memory
+# Inference gets its own pool, sized so a full batch can be in flight at once;
+# each session's slots keep unbatchable models at PIPELINE_WORKERS.
+INFERENCE_EXECUTOR = ThreadPoolExecutor(max_workers=max(BATCH_MAX_SIZE, PIPELINE_WORKERS))
+
+class ByteLRU:
+    """LRU cache of encoded results, bounded by total payload size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)